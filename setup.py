@@ -13,6 +13,9 @@ setup(
     install_requires=[
         'vumi>=0.6.0',
     ],
+    extras_require={
+        'ujson': ['ujson'],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
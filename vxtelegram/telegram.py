@@ -1,16 +1,55 @@
-import json
+import re
+
+try:
+    # ujson is considerably faster than the standard library's json module.
+    # Both encode to (ASCII) byte strings, which we pass straight to treq.
+    from ujson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import JSONEncoder, loads as json_loads
+    # Like ujson, leave out the whitespace json.dumps adds by default
+    json_dumps = JSONEncoder(separators=(',', ':')).encode
 
 from treq.client import HTTPClient
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import LoopingCall
 from twisted.web import http
-from twisted.web.client import Agent
+from twisted.web.client import Agent, HTTPConnectionPool
 
 from vumi.transports.httprpc.httprpc import HttpRpcTransport
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.config import ConfigText, ConfigUrl, ConfigDict, ConfigInt
 
+# Matches the update_id of a raw (unparsed) Telegram update
+UPDATE_ID_RE = re.compile(r'"update_id"\s*:\s*(\d+)')
+
+# Statuses that never vary, so there is no need to build them for every call
+STATUS_STARTING = dict(
+    status='down',
+    component='telegram_setup',
+    type='starting',
+    message='Telegram transport starting...',
+)
+STATUS_STARTED = dict(
+    status='ok',
+    component='telegram_setup',
+    type='started',
+    message='Telegram transport set up',
+)
+STATUS_GOOD_INBOUND = dict(
+    status='ok',
+    component='telegram_inbound',
+    type='good_inbound',
+    message='Good inbound request',
+)
+STATUS_GOOD_OUTBOUND = dict(
+    status='ok',
+    component='telegram_outbound',
+    type='good_outbound_request',
+    message='Outbound request successful',
+)
+
 
 class TelegramTransportConfig(HttpRpcTransport.CONFIG_CLASS):
     bot_username = ConfigText(
@@ -37,6 +76,10 @@ class TelegramTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         # Default: 24 hours (how long Telegram stores updates on their servers)
         default=(60 * 60 * 24), static=True, required=False,
     )
+    outbound_pool_size = ConfigInt(
+        'How many persistent connections to keep open to the Telegram API',
+        default=32, static=True, required=False,
+    )
 
 
 class TelegramTransport(HttpRpcTransport):
@@ -54,6 +97,34 @@ class TelegramTransport(HttpRpcTransport):
     # Telegram ids are integers that identify users to the Telegram API
     TELEGRAM_ID = 'telegram_id'
 
+    # update_ids are sequential, so we store them in sets of consecutive ids
+    # rather than under a key each. Sets this small are stored as compact
+    # integer arrays by Redis (see set-max-intset-entries).
+    UPDATE_ID_BUCKET_SIZE = 512
+
+    # Telegram can resend an update many times, so rather than logging every
+    # duplicate update we log how many we've discarded at this interval (in
+    # seconds)
+    DUPLICATE_LOG_INTERVAL = 60
+
+    # What we log when ignoring updates that don't contain text messages
+    NO_MESSAGE = 'Inbound update does not contain a message'
+    NOT_TEXT_MESSAGE = 'Inbound message is not a text message'
+
+    # Headers for all of our requests to the Telegram API
+    JSON_HEADERS = {'Content-Type': ['application/json']}
+
+    # sendMessage request body for messages without replies or formatting
+    TEXT_MESSAGE_PAYLOAD = '{"chat_id":%s,"text":%s}'
+
+    api_paths = [
+        'getWebhookInfo',
+        'setWebhook',
+        'sendMessage',
+        'answerCallbackQuery',
+        'answerInlineQuery',
+    ]
+
     media_api_path = {
         'photo': 'sendPhoto',
         'document': 'sendDocument',
@@ -62,40 +133,76 @@ class TelegramTransport(HttpRpcTransport):
         'location': 'sendLocation',
     }
 
-    @classmethod
-    def agent_factory(cls):
-        """
-        For swapping out the Agent we use in tests.
-        """
-        return Agent(reactor)
-
     @inlineCallbacks
     def setup_transport(self):
         yield super(TelegramTransport, self).setup_transport()
-        yield self.add_status_starting()
+        yield self.add_status(**STATUS_STARTING)
 
         config = self.get_static_config()
         self.api_url = '%s%s' % (config.outbound_url.geturl().rstrip('/'),
                                  config.bot_token)
+        self.outbound_urls = {
+            path: self.get_outbound_url(path)
+            for path in self.api_paths + self.media_api_path.values()
+        }
         self.inbound_url = config.inbound_url.geturl()
         self.bot_username = config.bot_username
+        # Logged for every inbound update, so only fill in our username once.
+        # vumi's logger doesn't interpolate arguments itself, so we can't
+        # leave the formatting to it.
+        self.inbound_log_format = (
+            'TelegramTransport receiving %%s from %%s to %s' %
+            self.bot_username.replace('%', '%%'))
+        self.update_lifetime = config.update_lifetime
+        self.reply_handlers = {
+            'inline_query': self.handle_outbound_inline_query,
+            'callback_query': self.handle_outbound_callback_query,
+        }
         self.redis = yield TxRedisManager.from_config(config.redis_manager)
 
+        self.duplicate_updates = 0
+        self.duplicate_log = LoopingCall(self.log_duplicate_updates)
+        self.duplicate_log.clock = self.clock
+        self.duplicate_log.start(self.DUPLICATE_LOG_INTERVAL, now=False)
+
+        # All requests to the Telegram API are made with this client, which
+        # tests replace to point requests at a fake server. It keeps
+        # connections alive between requests, so that we don't pay for a new
+        # TCP + TLS handshake on every outbound message.
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.outbound_pool_size
+        self.http_client = HTTPClient(Agent(reactor, pool=self.pool))
+
         yield self.setup_webhook()
-        yield self.add_status_started()
+        yield self.add_status(**STATUS_STARTED)
+
+    @inlineCallbacks
+    def teardown_transport(self):
+        yield super(TelegramTransport, self).teardown_transport()
+        # Setup may have failed before we got as far as creating these
+        duplicate_log = getattr(self, 'duplicate_log', None)
+        if duplicate_log is not None and duplicate_log.running:
+            duplicate_log.stop()
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            yield pool.closeCachedConnections()
 
     @inlineCallbacks
     def setup_webhook(self):
         """
-        Sets up a webhook to receive updates from Telegram.
+        Sets up a webhook to receive updates from Telegram, unless one is
+        already set up on our inbound URL.
         """
-        url = self.get_outbound_url('setWebhook')
-        http_client = HTTPClient(self.agent_factory())
+        webhook_url = yield self.get_webhook_url()
+        if webhook_url == self.inbound_url:
+            self.log.info('Webhook already set up on %s' % self.inbound_url)
+            yield self.add_status_good_webhook()
+            return
 
-        r = yield http_client.post(
-            url=url,
-            data=json.dumps({'url': self.inbound_url}),
-            headers={'Content-Type': ['application/json']},
+        r = yield self.http_client.post(
+            url=self.outbound_urls['setWebhook'],
+            data=json_dumps({'url': self.inbound_url}),
+            headers=self.JSON_HEADERS,
             allow_redirects=False,
         )
 
@@ -111,6 +218,31 @@ class TelegramTransport(HttpRpcTransport):
                 details=validate['details'],
             )
 
+    @inlineCallbacks
+    def get_webhook_url(self):
+        """
+        Returns the URL our webhook is currently set up on, or None if we
+        couldn't find out. This is only an optimisation, so failures are
+        logged rather than raised.
+        """
+        try:
+            r = yield self.http_client.get(
+                url=self.outbound_urls['getWebhookInfo'],
+                allow_redirects=False,
+            )
+            validate = yield self.validate_outbound(r)
+        except Exception as e:
+            self.log.warning('Webhook info request failed: %s' % e)
+            returnValue(None)
+
+        if not validate['success']:
+            self.log.warning(
+                'Webhook info request failed: %s' % validate['message'])
+            returnValue(None)
+        if not validate['result']:
+            returnValue(None)
+        returnValue(validate['result'].get('url'))
+
     def add_status_good_webhook(self):
         return self.add_status(
             status='ok',
@@ -132,24 +264,47 @@ class TelegramTransport(HttpRpcTransport):
     def get_outbound_url(self, path):
         return '%s/%s' % (self.api_url, path)
 
-    def log_inbound(self, update_type, user):
+    def log_inbound(self, update_type, user_id, username):
         """
-        Log the receipt of an inbound update.
+        Log the receipt of an inbound update, identifying the user by their
+        username if they have one.
         """
-        if user.get('username') is None:
-            user = user['id']
-        else:
-            user = user['username']
         self.log.info(
-            'TelegramTransport receiving %s from %s to %s' % (
-                update_type, user, self.bot_username))
+            self.inbound_log_format % (update_type, username or user_id))
 
     @inlineCallbacks
     def handle_raw_inbound_message(self, message_id, request):
         content = yield request.content.read()
+
+        update_id = self.extract_update_id(content)
+        if update_id is not None:
+            # Most updates we don't handle can be recognised without parsing
+            # them, or claiming them in Redis. This is a deliberate trade-off:
+            # a malformed body that has an update_id but none of the fields we
+            # handle is ignored like any other such update, rather than
+            # reported as being in an unexpected format. Bodies without an
+            # update_id are always parsed, and reported if malformed.
+            reason = self.probe_update(content)
+            if reason is not None:
+                self.log.info(reason)
+                request.finish()
+                return
+
+            # Telegram resends updates that aren't acknowledged quickly
+            # enough, so we check for duplicates before doing a full parse
+            claimed = yield self.claim_update(update_id)
+            if not claimed:
+                self.duplicate_updates += 1
+                request.finish()
+                return
+
         try:
-            update = json.loads(content)
+            update = json_loads(content)
+            if update_id is None:
+                raise ValueError('Update does not contain an update_id')
         except ValueError as e:
+            if update_id is not None:
+                yield self.release_update(update_id)
             self.log.warning('Inbound update in unexpected format: %s' % e)
             yield self.add_status_bad_inbound(
                 status_type='unexpected_update_format',
@@ -160,15 +315,6 @@ class TelegramTransport(HttpRpcTransport):
             request.finish()
             return
 
-        # Do not process duplicate requests
-        update_id = update['update_id']
-        is_duplicate = yield self.is_duplicate(update_id)
-        if is_duplicate:
-            self.log.info('Received a duplicate update: %s' % update_id)
-            request.finish()
-            return
-        yield self.mark_as_seen(update_id)
-
         # Handle callback queries separately
         if 'callback_query' in update:
             yield self.handle_inbound_callback_query(
@@ -189,22 +335,20 @@ class TelegramTransport(HttpRpcTransport):
 
         # Ignore updates that do not contain message objects
         if 'message' not in update:
-            self.log.info('Inbound update does not contain a message')
+            self.log.info(self.NO_MESSAGE)
             request.finish()
             return
 
         # Ignore messages that aren't text messages
         message = update['message']
         if 'text' not in message:
-            self.log.info('Inbound message is not a text message')
+            self.log.info(self.NOT_TEXT_MESSAGE)
             request.finish()
             return
 
-        message = self.translate_inbound_message(update['message'])
-        self.log_inbound('message', {
-            'id': message['from_addr'],
-            'username': message['telegram_username'],
-        })
+        message = self.translate_inbound_message(message)
+        self.log_inbound(
+            'message', message['from_addr'], message['telegram_username'])
 
         yield self.publish_message(
             message_id=message_id,
@@ -224,33 +368,65 @@ class TelegramTransport(HttpRpcTransport):
             },
         )
 
-        yield self.add_status(
-            status='ok',
-            component='telegram_inbound',
-            type='good_inbound',
-            message='Good inbound request',
-        )
+        self.add_status(**STATUS_GOOD_INBOUND)
         request.finish()
 
-    def get_update_id_key(self, update_id):
-        return 'update_id:%s' % update_id
+    def log_duplicate_updates(self):
+        """
+        Logs how many duplicate updates we've discarded since we last checked.
+        """
+        if self.duplicate_updates:
+            self.log.info('Discarded %s duplicate update(s)' % (
+                self.duplicate_updates,))
+            self.duplicate_updates = 0
 
-    @inlineCallbacks
-    def is_duplicate(self, update_id):
+    def extract_update_id(self, content):
         """
-        Checks to see if an inbound update has already been processed.
+        Pulls the update_id out of a raw update without parsing the rest of it.
+        Returns None if the update does not appear to contain an update_id.
         """
-        exists = yield self.redis.exists(self.get_update_id_key(update_id))
-        returnValue(exists)
+        match = UPDATE_ID_RE.search(content)
+        if match is None:
+            return None
+        return int(match.group(1))
 
-    @inlineCallbacks
-    def mark_as_seen(self, update_id):
+    def probe_update(self, content):
         """
-        Adds an update_id to a list of update_ids already processed.
+        Checks a raw update for the fields we need in order to handle it, and
+        returns the reason for ignoring it if they are missing. Returns None if
+        the update needs to be parsed to decide.
+        """
+        if '"callback_query"' in content or '"inline_query"' in content:
+            return None
+        if '"message"' not in content:
+            return self.NO_MESSAGE
+        if '"text"' not in content:
+            return self.NOT_TEXT_MESSAGE
+        return None
+
+    def get_update_id_key(self, update_id):
+        return 'update_ids:%s' % (update_id // self.UPDATE_ID_BUCKET_SIZE)
+
+    def claim_update(self, update_id):
+        """
+        Marks an update as processed, returning False if it already was.
         """
-        config = self.get_static_config()
         key = self.get_update_id_key(update_id)
-        yield self.redis.setex(key, 1, config.update_lifetime)
+
+        # Send both commands without waiting for the first reply, so that
+        # they share a single round trip to Redis
+        d = gatherResults([
+            self.redis.sadd(key, update_id),
+            self.redis.expire(key, self.update_lifetime),
+        ], consumeErrors=True)
+        return d.addCallback(lambda results: bool(results[0]))
+
+    def release_update(self, update_id):
+        """
+        Unmarks an update we claimed but couldn't process, so that Telegram's
+        retry of it isn't discarded as a duplicate.
+        """
+        return self.redis.srem(self.get_update_id_key(update_id), update_id)
 
     def add_status_bad_inbound(self, status_type, message, details):
         return self.add_status(
@@ -267,14 +443,15 @@ class TelegramTransport(HttpRpcTransport):
         Handles an inbound callback query, fired when a user makes a selection
         on an inline keyboard.
         """
-        self.log_inbound('callback query', callback_query['from'])
+        user = callback_query['from']
+        self.log_inbound('callback query', user['id'], user.get('username'))
 
         metadata = {
            'type': 'callback_query',
            'reply': callback_query.get('data'),
            'details': {'callback_query_id': callback_query['id']},
         }
-        telegram_username = callback_query['from'].get('username')
+        telegram_username = user.get('username')
         if telegram_username:
             metadata['telegram_username'] = telegram_username
 
@@ -283,7 +460,7 @@ class TelegramTransport(HttpRpcTransport):
             content='',
             to_addr=self.bot_username,
             to_addr_type=self.TELEGRAM_USERNAME,
-            from_addr=callback_query['from']['id'],
+            from_addr=user['id'],
             from_addr_type=self.TELEGRAM_ID,
             transport_type=self.transport_type,
             transport_name=self.transport_name,
@@ -291,27 +468,22 @@ class TelegramTransport(HttpRpcTransport):
             transport_metadata=metadata,
         )
 
-        yield self.add_status(
-            status='ok',
-            component='telegram_inbound',
-            type='good_inbound',
-            message='Good inbound request',
-        )
+        self.add_status(**STATUS_GOOD_INBOUND)
 
     @inlineCallbacks
     def handle_inbound_inline_query(self, message_id, inline_query):
         """
         Handles an inbound inline query from a Telegram user.
         """
-        self.log_inbound('inline query', inline_query['from'])
-
+        user = inline_query['from']
+        self.log_inbound('inline query', user['id'], user.get('username'))
 
         metadata = {
-           'type': 'callback_query',
+           'type': 'inline_query',
            'reply': inline_query['query'],
-           'details': {'callback_query_id': callback_query['id']},
+           'details': {'inline_query_id': inline_query['id']},
         }
-        telegram_username = callback_query['from'].get('username')
+        telegram_username = user.get('username')
         if telegram_username:
             metadata['telegram_username'] = telegram_username
 
@@ -320,7 +492,7 @@ class TelegramTransport(HttpRpcTransport):
             content='',
             to_addr=self.bot_username,
             to_addr_type=self.TELEGRAM_USERNAME,
-            from_addr=inline_query['from']['id'],
+            from_addr=user['id'],
             from_addr_type=self.TELEGRAM_ID,
             transport_type=self.transport_type,
             transport_name=self.transport_name,
@@ -328,12 +500,7 @@ class TelegramTransport(HttpRpcTransport):
             transport_metadata=metadata,
         )
 
-        yield self.add_status(
-            status='ok',
-            component='telegram_inbound',
-            type='good_inbound',
-            message='Good inbound request',
-        )
+        self.add_status(**STATUS_GOOD_INBOUND)
 
     def translate_inbound_message(self, message):
         """
@@ -361,47 +528,52 @@ class TelegramTransport(HttpRpcTransport):
     @inlineCallbacks
     def handle_outbound_message(self, message):
         message_id = message['message_id']
+        transport_metadata = message['transport_metadata']
         metadata = message['helper_metadata'].get('telegram')
 
-        # Handle replies to inline queries separately
-        if message['transport_metadata'].get('type') == 'inline_query':
-            yield self.handle_outbound_inline_query(message_id, message)
+        # Handle replies to inline queries and callback queries separately
+        reply_handler = self.reply_handlers.get(transport_metadata.get('type'))
+        if reply_handler is not None:
+            yield reply_handler(message_id, message)
             return
 
-        # Handle replies to callback queries separately
-        if message['transport_metadata'].get('type') == 'callback_query':
-            yield self.handle_outbound_callback_query(message_id, message)
+        # Handle messages with media attachments
+        if metadata and metadata.get('attachment') is not None:
+            yield self.handle_outbound_media_message(message_id, message)
             return
 
-        # Handle messages with media attachments
-        if metadata is not None:
-            attachment = metadata.get('attachment')
-            if attachment is not None:
-                yield self.handle_outbound_media_message(message_id, message)
-                return
+        telegram_msg_id = None
+        if message.get('in_reply_to') is not None:
+            telegram_msg_id = transport_metadata.get('telegram_msg_id')
 
-        outbound_msg = {
-            'chat_id': message['to_addr'],
-            'text': message['content'],
-        }
+        if telegram_msg_id or metadata:
+            outbound_msg = {
+                'chat_id': message['to_addr'],
+                'text': message['content'],
+            }
 
-        # Handle direct replies
-        if message.get('in_reply_to') is not None:
-            telegram_msg_id = message['transport_metadata'].get('telegram_msg_id')
+            # Handle direct replies
             if telegram_msg_id:
-                outbound_msg.update({'reply_to_message_id': telegram_msg_id})
+                outbound_msg['reply_to_message_id'] = telegram_msg_id
 
-        # Handle message formatting options (pass if none are provided)
-        if metadata is not None:
-            outbound_msg.update(metadata)
+            # Handle message formatting options
+            if metadata:
+                outbound_msg.update(metadata)
 
-        url = self.get_outbound_url('sendMessage')
-        http_client = HTTPClient(self.agent_factory())
-
-        r = yield http_client.post(
-            url=url,
-            data=json.dumps(outbound_msg),
-            headers={'Content-Type': ['application/json']},
+            data = json_dumps(outbound_msg)
+        else:
+            # Messages with no reply and no telegram helper metadata (such as
+            # unsolicited sends) only carry chat_id and text, so we splice
+            # those into a pre-built payload instead of encoding a dict.
+            # Replies made with reply() always take the general path above,
+            # since they carry the inbound message's helper metadata.
+            data = self.TEXT_MESSAGE_PAYLOAD % (
+                json_dumps(message['to_addr']), json_dumps(message['content']))
+
+        r = yield self.http_client.post(
+            url=self.outbound_urls['sendMessage'],
+            data=data,
+            headers=self.JSON_HEADERS,
             allow_redirects=False,
         )
 
@@ -423,27 +595,23 @@ class TelegramTransport(HttpRpcTransport):
         """
         att = message['helper_metadata']['telegram']['attachment']
         try:
-            url = self.get_outbound_url(self.media_api_path[att['type']])
+            url = self.outbound_urls[self.media_api_path[att['type']]]
         except KeyError:
             self.log.info('Unsupported attachment type: %s' % att.get('type'))
             return
 
-        http_client = HTTPClient(self.agent_factory())
-        params = {
-            'chat_id': message['to_addr'],
-        }
-        params.update(att)
-        del params['type']
+        params = {k: v for k, v in att.iteritems() if k != 'type'}
+        params['chat_id'] = message['to_addr']
 
         # Handle direct replies
         if message['in_reply_to'] is not None:
             telegram_msg_id = message['transport_metadata']['telegram_msg_id']
-            params.update({'reply_to_message_id': telegram_msg_id})
+            params['reply_to_message_id'] = telegram_msg_id
 
-        r = yield http_client.post(
+        r = yield self.http_client.post(
             url=url,
-            data=json.dumps(params),
-            headers={'Content-Type': ['application/json']},
+            data=json_dumps(params),
+            headers=self.JSON_HEADERS,
             allow_redirects=False,
         )
 
@@ -472,8 +640,7 @@ class TelegramTransport(HttpRpcTransport):
         must be called after receiving a callback query (even if we do not
         send a reply) to prevent the user being stuck with a progress bar.
         """
-        url = self.get_outbound_url('answerCallbackQuery')
-        http_client = HTTPClient(self.agent_factory())
+        url = self.outbound_urls['answerCallbackQuery']
 
         qry_id = message['transport_metadata']['details']['callback_query_id']
 
@@ -483,10 +650,10 @@ class TelegramTransport(HttpRpcTransport):
         }
         params.update(message['helper_metadata']['telegram'].get('details'))
 
-        r = yield http_client.post(
+        r = yield self.http_client.post(
             url=url,
-            data=json.dumps(params),
-            headers={'Content-Type': ['application/json']},
+            data=json_dumps(params),
+            headers=self.JSON_HEADERS,
             allow_redirects=False,
         )
 
@@ -515,8 +682,7 @@ class TelegramTransport(HttpRpcTransport):
         Handles replies to inline queries. We rely on the application worker to
         generate the result(s).
         """
-        url = self.get_outbound_url('answerInlineQuery')
-        http_client = HTTPClient(self.agent_factory())
+        url = self.outbound_urls['answerInlineQuery']
 
         query_id = message['transport_metadata']['details']['inline_query_id']
 
@@ -550,10 +716,10 @@ class TelegramTransport(HttpRpcTransport):
             )
             return
 
-        r = yield http_client.post(
+        r = yield self.http_client.post(
             url=url,
-            data=json.dumps(outbound_query_answer),
-            headers={'Content-Type': ['application/json']},
+            data=json_dumps(outbound_query_answer),
+            headers=self.JSON_HEADERS,
             allow_redirects=False,
         )
 
@@ -595,10 +761,10 @@ class TelegramTransport(HttpRpcTransport):
                 },
             })
 
+        content = yield response.content()
         try:
-            res = yield response.json()
+            res = json_loads(content)
         except ValueError as e:
-            content = yield response.content()
             returnValue({
                 'success': False,
                 'message': 'unexpected response format',
@@ -611,7 +777,7 @@ class TelegramTransport(HttpRpcTransport):
             })
 
         if response.code == http.OK and res['ok']:
-            returnValue({'success': True})
+            returnValue({'success': True, 'result': res.get('result')})
         else:
             returnValue({
                 'success': False,
@@ -623,15 +789,21 @@ class TelegramTransport(HttpRpcTransport):
                 },
             })
 
-    @inlineCallbacks
     def outbound_failure(self, status_type, message_id, message, details):
-        yield self.publish_nack(message_id, message)
-        yield self.add_status_bad_outbound(status_type, message, details)
+        # The nack and the status are independent, so publish them together
+        d = gatherResults([
+            self.publish_nack(message_id, message),
+            self.add_status_bad_outbound(status_type, message, details),
+        ], consumeErrors=True)
+        # Hand callers the original error rather than gatherResults' wrapper
+        return d.addErrback(lambda f: f.value.subFailure)
 
-    @inlineCallbacks
     def outbound_success(self, message_id):
-        yield self.publish_ack(message_id, message_id)
-        yield self.add_status_good_outbound()
+        d = gatherResults([
+            self.publish_ack(message_id, message_id),
+            self.add_status(**STATUS_GOOD_OUTBOUND),
+        ], consumeErrors=True)
+        return d.addErrback(lambda f: f.value.subFailure)
 
     def add_status_bad_outbound(self, status_type, message, details):
         return self.add_status(
@@ -641,27 +813,3 @@ class TelegramTransport(HttpRpcTransport):
             message=message,
             details=details,
         )
-
-    def add_status_good_outbound(self):
-        return self.add_status(
-            status='ok',
-            component='telegram_outbound',
-            type='good_outbound_request',
-            message='Outbound request successful',
-        )
-
-    def add_status_starting(self):
-        return self.add_status(
-            status='down',
-            component='telegram_setup',
-            type='starting',
-            message='Telegram transport starting...',
-        )
-
-    def add_status_started(self):
-        return self.add_status(
-            status='ok',
-            component='telegram_setup',
-            type='started',
-            message='Telegram transport set up',
-        )
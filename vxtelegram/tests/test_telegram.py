@@ -1,6 +1,11 @@
 import json
 
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredQueue
+from treq.client import HTTPClient
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredQueue, fail)
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Clock
 from twisted.web.server import NOT_DONE_YET
 from twisted.web import http
 
@@ -60,7 +65,7 @@ class TestTelegramTransport(VumiTestCase):
         }
         defaults.update(config)
         transport = yield self.helper.get_transport(defaults)
-        transport.agent_factory = self.mock_server.get_agent
+        transport.http_client = HTTPClient(self.mock_server.get_agent())
         returnValue(transport)
 
     def handle_inbound_request(self, req):
@@ -73,6 +78,18 @@ class TestTelegramTransport(VumiTestCase):
         self.pending_requests.append(req)
         returnValue(req)
 
+    @inlineCallbacks
+    def respond_to_webhook_info(self, webhook_url=''):
+        """
+        Answers the getWebhookInfo request made when setting up a webhook.
+        """
+        req = yield self.get_next_request()
+        self.assertEqual(req.method, 'GET')
+        self.assertEqual(
+            req.path, '%s%s/getWebhookInfo' % (self.API_URL, self.TOKEN))
+        req.write(json.dumps({'ok': True, 'result': {'url': webhook_url}}))
+        req.finish()
+
     @inlineCallbacks
     def finish_requests(self):
         for req in self.pending_requests:
@@ -115,6 +132,51 @@ class TestTelegramTransport(VumiTestCase):
         expected_url = '%s%s/%s' % (self.API_URL, self.TOKEN, 'myPath')
         self.assertEqual(test_url, expected_url)
 
+    @inlineCallbacks
+    def test_outbound_urls(self):
+        """
+        We should build the URLs for all of the API methods we use up front.
+        """
+        transport = yield self.get_transport()
+        for path in ['sendMessage', 'setWebhook', 'sendPhoto']:
+            expected_url = '%s%s/%s' % (self.API_URL, self.TOKEN, path)
+            self.assertEqual(transport.outbound_urls[path], expected_url)
+
+    @inlineCallbacks
+    def test_outbound_pool_size(self):
+        """
+        The number of persistent connections we keep open to the Telegram API
+        should follow our config.
+        """
+        transport = yield self.get_transport(outbound_pool_size=5)
+        self.assertEqual(transport.pool.maxPersistentPerHost, 5)
+
+    @inlineCallbacks
+    def test_teardown_closes_connections(self):
+        """
+        We should close our cached connections to the Telegram API when the
+        transport is torn down.
+        """
+        transport = yield self.get_transport()
+        closed = []
+        transport.pool.closeCachedConnections = lambda: closed.append(True)
+
+        yield transport.teardown_transport()
+        self.assertTrue(closed)
+
+    @inlineCallbacks
+    def test_teardown_without_connection_pool(self):
+        """
+        If setup failed before our connection pool was created, tearing down
+        the transport should not fail.
+        """
+        transport = yield self.get_transport()
+        transport.duplicate_log.stop()
+        del transport.duplicate_log
+        del transport.pool
+
+        yield transport.teardown_transport()
+
     @inlineCallbacks
     def test_setup_webhook_no_errors(self):
         """
@@ -125,6 +187,7 @@ class TestTelegramTransport(VumiTestCase):
         yield self.helper.clear_dispatched_statuses()
 
         d = transport.setup_webhook()
+        yield self.respond_to_webhook_info()
         expected_url = '%s%s/%s' % (self.API_URL.rstrip('/'), self.TOKEN,
                                     'setWebhook')
 
@@ -151,6 +214,84 @@ class TestTelegramTransport(VumiTestCase):
             'details': {'webhook_url': 'www.example.com'},
         })
 
+    @inlineCallbacks
+    def test_setup_webhook_already_set_up(self):
+        """
+        If our webhook is already set up on our inbound URL, we should not set
+        it up again, but should still log it and publish an 'ok' status.
+        """
+        transport = yield self.get_transport(publish_status=True)
+        yield self.helper.clear_dispatched_statuses()
+
+        d = transport.setup_webhook()
+        with LogCatcher(message='Webhook') as lc:
+            yield self.respond_to_webhook_info('www.example.com')
+            yield d
+            [log] = lc.messages()
+            self.assertEqual(log, 'Webhook already set up on www.example.com')
+        self.assertEqual(self.request_queue.pending, [])
+
+        [status] = yield self.helper.wait_for_dispatched_statuses()
+        self.assert_dict(status, {
+            'status': 'ok',
+            'component': 'telegram_webhook',
+            'type': 'webhook_setup_success',
+            'message': 'Webhook setup successful',
+            'details': {'webhook_url': 'www.example.com'},
+        })
+
+    @inlineCallbacks
+    def test_setup_webhook_info_bad_response(self):
+        """
+        If Telegram won't tell us where our webhook is set up, we should log
+        it and set the webhook up anyway.
+        """
+        transport = yield self.get_transport()
+        d = transport.setup_webhook()
+
+        req = yield self.get_next_request()
+        self.assertEqual(req.method, 'GET')
+        req.setResponseCode(http.BAD_REQUEST)
+        req.write(json.dumps(self.bad_telegram_response))
+        with LogCatcher(message='Webhook info') as lc:
+            req.finish()
+            req = yield self.get_next_request()
+            [log] = lc.messages()
+            self.assertEqual(
+                log,
+                'Webhook info request failed: bad response from Telegram',
+            )
+
+        self.assertEqual(req.method, 'POST')
+        self.assertEqual(
+            req.path, '%s%s/setWebhook' % (self.API_URL, self.TOKEN))
+        req.write(json.dumps({'ok': True}))
+        req.finish()
+        yield d
+
+    @inlineCallbacks
+    def test_setup_webhook_info_request_fails(self):
+        """
+        If our request for webhook info fails outright, we should log it and
+        set the webhook up anyway.
+        """
+        transport = yield self.get_transport()
+        transport.http_client.get = (
+            lambda *args, **kwargs: fail(ConnectionRefusedError()))
+
+        with LogCatcher(message='Webhook info') as lc:
+            d = transport.setup_webhook()
+            req = yield self.get_next_request()
+            [log] = lc.messages()
+            self.assertSubstring('Webhook info request failed', log)
+
+        self.assertEqual(req.method, 'POST')
+        self.assertEqual(
+            req.path, '%s%s/setWebhook' % (self.API_URL, self.TOKEN))
+        req.write(json.dumps({'ok': True}))
+        req.finish()
+        yield d
+
     @inlineCallbacks
     def test_setup_webhook_with_errors(self):
         """
@@ -167,6 +308,7 @@ class TestTelegramTransport(VumiTestCase):
         yield self.helper.clear_dispatched_statuses()
 
         d = transport.setup_webhook()
+        yield self.respond_to_webhook_info()
 
         req = yield self.get_next_request()
         req.setResponseCode(http.BAD_REQUEST)
@@ -199,6 +341,7 @@ class TestTelegramTransport(VumiTestCase):
         yield self.helper.clear_dispatched_statuses()
 
         d = transport.setup_webhook()
+        yield self.respond_to_webhook_info()
         req = yield self.get_next_request()
 
         req.setResponseCode(http.FOUND)
@@ -231,6 +374,7 @@ class TestTelegramTransport(VumiTestCase):
         yield self.helper.clear_dispatched_statuses()
 
         d = transport.setup_webhook()
+        yield self.respond_to_webhook_info()
         req = yield self.get_next_request()
 
         req.setResponseCode(http.INTERNAL_SERVER_ERROR)
@@ -307,36 +451,132 @@ class TestTelegramTransport(VumiTestCase):
         meaning they should no longer be considered duplicates.
         """
         transport = yield self.get_transport(update_lifetime=10)
-        yield transport.mark_as_seen(1234)
+        claimed = yield transport.claim_update(1234)
+        self.assertTrue(claimed)
 
-        duplicate = yield transport.is_duplicate(1234)
-        self.assertTrue(duplicate)
-        ttl = yield transport.redis.ttl(1234)
-        self.assertTrue(ttl <= 10)
+        claimed = yield transport.claim_update(1234)
+        self.assertFalse(claimed)
+        ttl = yield transport.redis.ttl(transport.get_update_id_key(1234))
+        self.assertTrue(0 < ttl <= 10)
+
+    @inlineCallbacks
+    def test_update_id_buckets(self):
+        """
+        update_ids should be stored in sets of consecutive ids, and ids that
+        share a set should not be mistaken for one another.
+        """
+        transport = yield self.get_transport()
+        bucket_size = transport.UPDATE_ID_BUCKET_SIZE
+        self.assertEqual(
+            transport.get_update_id_key(1234),
+            transport.get_update_id_key(1235),
+        )
+        self.assertNotEqual(
+            transport.get_update_id_key(1234),
+            transport.get_update_id_key(1234 + bucket_size),
+        )
+
+        claimed = yield transport.claim_update(1234)
+        self.assertTrue(claimed)
+        claimed = yield transport.claim_update(1235)
+        self.assertTrue(claimed)
+
+        members = yield transport.redis.smembers(
+            transport.get_update_id_key(1234))
+        self.assertEqual(set(members), set(['1234', '1235']))
 
     @inlineCallbacks
     def test_duplicate_update(self):
         """
-        We should log receipt of duplicate updates and discard them.
+        We should discard duplicate updates, and periodically log how many
+        we've discarded.
         """
-        yield self.get_transport()
-        update = {'update_id': 1234}
+        clock = Clock()
+        self.patch(TelegramTransport, 'get_clock', lambda _: clock)
+        transport = yield self.get_transport()
+        self.assertTrue(transport.duplicate_log.running)
+        update = {
+            'update_id': 1234,
+            'message': {
+                'message_id': 5678,
+                'from': self.default_user,
+                'chat': {'id': 'chat_id', 'type': self.PRIVATE},
+                'date': 1234,
+                'text': 'Incoming message from Telegram!',
+            },
+        }
 
         # Make initial request
-        d = self.helper.mk_request(_method='POST', _data=json.dumps(update))
-        with LogCatcher(message='message') as lc:
-            res = yield d
-            [log] = lc.messages()
-            self.assertEqual(log, 'Inbound update does not contain a message')
+        res = yield self.helper.mk_request(
+            _method='POST', _data=json.dumps(update))
         self.assertEqual(res.code, http.OK)
 
-        # Make duplicate request
-        d = self.helper.mk_request(_method='POST', _data=json.dumps(update))
+        # Make duplicate requests
+        for _ in range(2):
+            res = yield self.helper.mk_request(
+                _method='POST', _data=json.dumps(update))
+            self.assertEqual(res.code, http.OK)
+
+        # Nothing should be logged until the interval has elapsed
+        with LogCatcher(message='duplicate') as lc:
+            clock.advance(transport.DUPLICATE_LOG_INTERVAL - 1)
+            self.assertEqual(lc.messages(), [])
+            clock.advance(1)
+            [log] = lc.messages()
+            self.assertEqual(log, 'Discarded 2 duplicate update(s)')
+
+        # We should only log duplicates we haven't logged yet
         with LogCatcher(message='duplicate') as lc:
+            clock.advance(transport.DUPLICATE_LOG_INTERVAL)
+            self.assertEqual(lc.messages(), [])
+
+        # Only the initial request should have been published
+        msgs = yield self.helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(len(msgs), 1)
+
+        # Logging should stop when the transport does
+        yield transport.teardown_transport()
+        self.assertFalse(transport.duplicate_log.running)
+
+    @inlineCallbacks
+    def test_extract_update_id(self):
+        """
+        We should be able to pull the update_id out of a raw update without
+        parsing it, and get None back if there is no update_id.
+        """
+        transport = yield self.get_transport()
+        update = json.dumps({
+            'update_id': 1234,
+            'message': {'message_id': 5678, 'text': 'Hi!'},
+        })
+        self.assertEqual(transport.extract_update_id(update), 1234)
+        self.assertEqual(transport.extract_update_id('{"update_id" : 42}'), 42)
+        self.assertIsNone(transport.extract_update_id('{"message": {}}'))
+
+    @inlineCallbacks
+    def test_inbound_update_without_update_id(self):
+        """
+        We should log a warning and publish a down status when we receive
+        updates that do not contain an update_id.
+        """
+        yield self.get_transport(publish_status=True)
+        yield self.helper.clear_dispatched_statuses()
+
+        update = json.dumps({'message': {'message_id': 5678, 'text': 'Hi!'}})
+        d = self.helper.mk_request(_method='POST', _data=update)
+        with LogCatcher(message='unexpected') as lc:
             res = yield d
             [log] = lc.messages()
-            self.assertEqual(log, 'Received a duplicate update: 1234')
-        self.assertEqual(res.code, http.OK)
+            self.assertSubstring('Update does not contain an update_id', log)
+        self.assertEqual(res.code, http.BAD_REQUEST)
+
+        [status] = yield self.helper.wait_for_dispatched_statuses()
+        self.assert_dict(status, {
+            'status': 'down',
+            'component': 'telegram_inbound',
+            'type': 'unexpected_update_format',
+            'message': 'Inbound update in unexpected format',
+        })
 
     @inlineCallbacks
     def test_inbound_update(self):
@@ -550,6 +790,81 @@ class TestTelegramTransport(VumiTestCase):
             self.assertEqual(log, 'Inbound message is not a text message')
         self.assertEqual(res.code, http.OK)
 
+    @inlineCallbacks
+    def test_probe_update(self):
+        """
+        We should be able to tell from a raw update whether it definitely
+        doesn't contain anything we handle.
+        """
+        transport = yield self.get_transport()
+
+        update = json.dumps({'update_id': 1, 'edited_message': {'text': ''}})
+        self.assertEqual(
+            transport.probe_update(update),
+            'Inbound update does not contain a message')
+
+        update = json.dumps({'update_id': 1, 'message': {'photo': []}})
+        self.assertEqual(
+            transport.probe_update(update),
+            'Inbound message is not a text message')
+
+        update = json.dumps({'update_id': 1, 'message': {'text': 'Hi!'}})
+        self.assertIsNone(transport.probe_update(update))
+
+        update = json.dumps({'update_id': 1, 'callback_query': {'id': '1'}})
+        self.assertIsNone(transport.probe_update(update))
+
+    @inlineCallbacks
+    def test_inbound_update_truncated(self):
+        """
+        If an update can't be parsed, we should not mark it as processed, so
+        that we still handle Telegram's retry of it.
+        """
+        yield self.get_transport()
+        update = json.dumps({
+            'update_id': 1234,
+            'message': {
+                'message_id': 5678,
+                'from': self.default_user,
+                'chat': {'id': 'chat_id', 'type': self.PRIVATE},
+                'date': 1234,
+                'text': 'Incoming message from Telegram!',
+            },
+        })
+
+        res = yield self.helper.mk_request(
+            _method='POST', _data=update[:-2])
+        self.assertEqual(res.code, http.BAD_REQUEST)
+
+        d = self.helper.mk_request(_method='POST', _data=update)
+        with LogCatcher(message='TelegramTransport') as lc:
+            res = yield d
+            self.assertEqual(len(lc.messages()), 1)
+        self.assertEqual(res.code, http.OK)
+
+        [msg] = yield self.helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], 'Incoming message from Telegram!')
+
+    @inlineCallbacks
+    def test_inbound_update_ignored_without_parsing(self):
+        """
+        Updates that can't contain anything we handle should be ignored
+        without being claimed, even if they are malformed.
+        """
+        transport = yield self.get_transport()
+
+        d = self.helper.mk_request(
+            _method='POST', _data='{"update_id": 1234, garbage')
+        with LogCatcher(message='message') as lc:
+            res = yield d
+            [log] = lc.messages()
+            self.assertEqual(log, 'Inbound update does not contain a message')
+        self.assertEqual(res.code, http.OK)
+
+        members = yield transport.redis.smembers(
+            transport.get_update_id_key(1234))
+        self.assertEqual(list(members), [])
+
     @inlineCallbacks
     def test_inbound_update_unexpected_format(self):
         """
@@ -981,6 +1296,34 @@ class TestTelegramTransport(VumiTestCase):
             'message': 'Outbound request successful',
         })
 
+    @inlineCallbacks
+    def test_outbound_message_special_characters(self):
+        """
+        Plain text messages should be encoded correctly even if they contain
+        characters that have to be escaped in JSON.
+        """
+        yield self.get_transport()
+        content = u'"Quotes", back\\slashes,\nnewlines and \u00fcnicode'
+
+        msg = self.helper.make_outbound(
+            content=content,
+            to_addr=self.default_user['id'],
+            to_addr_type=self.TELEGRAM_ID,
+            from_addr=self.bot_username,
+        )
+        d = self.helper.dispatch_outbound(msg)
+
+        req = yield self.get_next_request()
+        outbound_msg = json.load(req.content)
+        self.assertEqual(outbound_msg, {
+            'chat_id': self.default_user['id'],
+            'text': content,
+        })
+
+        req.write(json.dumps({'ok': True}))
+        req.finish()
+        yield d
+
     @inlineCallbacks
     def test_outbound_message_with_formatting(self):
         """
@@ -1062,6 +1405,44 @@ class TestTelegramTransport(VumiTestCase):
 
         yield self.assert_ack(msg['message_id'])
 
+    @inlineCallbacks
+    def test_outbound_reply_with_inbound_metadata(self):
+        """
+        Replies carry the helper metadata of the message they reply to, and
+        should still be sent as replies with the right content.
+        """
+        yield self.get_transport()
+        inbound = self.helper.make_inbound(
+            'Incoming message from Telegram!',
+            from_addr=self.default_user['id'],
+            from_addr_type=self.TELEGRAM_ID,
+            to_addr=self.bot_username,
+            to_addr_type=self.TELEGRAM_USERNAME,
+            helper_metadata={'telegram': {
+                'telegram_username': self.default_user['username'],
+            }},
+            transport_metadata={
+                'telegram_msg_id': 1234,
+                'telegram_username': self.default_user['username'],
+            },
+        )
+        msg = inbound.reply('Outbound reply!')
+        d = self.helper.dispatch_outbound(msg)
+
+        req = yield self.get_next_request()
+        outbound_msg = json.load(req.content)
+        self.assert_dict(outbound_msg, {
+            'text': 'Outbound reply!',
+            'chat_id': self.default_user['id'],
+            'reply_to_message_id': 1234,
+        })
+
+        req.write(json.dumps({'ok': True}))
+        req.finish()
+        yield d
+
+        yield self.assert_ack(msg['message_id'])
+
     @inlineCallbacks
     def test_outbound_message_with_errors(self):
         """
@@ -1215,6 +1596,32 @@ class TestTelegramTransport(VumiTestCase):
             'message': 'Outbound request successful',
         })
 
+    @inlineCallbacks
+    def test_outbound_publish_error(self):
+        """
+        If publishing an ack or nack fails, the original error should reach
+        the caller.
+        """
+        transport = yield self.get_transport()
+
+        def publish_error(*args, **kwargs):
+            return fail(ValueError('Publish failed'))
+
+        transport.publish_ack = publish_error
+        transport.publish_nack = publish_error
+
+        yield self.assertFailure(
+            transport.outbound_success(message_id='id'), ValueError)
+        yield self.assertFailure(
+            transport.outbound_failure(
+                status_type='test',
+                message_id='id',
+                message='Some kind of error',
+                details={},
+            ),
+            ValueError,
+        )
+
     def assert_dict(self, dictionary, expected_fields):
         """
         Helper method for asserting that a dict contains the expected fields.